@@ -19,24 +19,62 @@ Original tool by initstring. If you're into cracking complex passwords, check ou
 github.com/initstring/passphrase-wordlist for more fun!
 """
 
-from functools import partial
-from time import sleep
-from multiprocessing import Queue
-import multiprocessing
-import textwrap
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import chain
+from typing import BinaryIO, TextIO
+import asyncio
 import argparse
-import urllib.request
 import datetime
 import os
 import sys
 import re
+import string
 import unicodedata
 
+import aiohttp
+
 SITE = "https://www.lyrics.com/"
+# No Accept-Encoding here: aiohttp already asks for gzip / deflate (plus br when
+# Brotli is installed) and transparently decompresses whatever comes back
 HEADER = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/119.0"
 }
-QUEUE_SENTINEL = "ENQUEUE"
+HTTP_TIMEOUT = 30
+WRITE_BUFFER = 1 << 20
+READ_BLOCK = 1 << 20
+
+_MULTISPACE = re.compile(r" {2,}")
+_WHITELIST = re.compile("[^a-zA-Z0-9-+]")
+
+# Pages are scanned as raw bytes instead of being decoded to a str first
+_HREF = re.compile(rb'href="/lyric/([^/"]+)/')
+_PRE = re.compile(rb"<pre.*?>(.*?)</pre>", re.DOTALL)
+
+
+class _CleanTable(dict):
+    """
+    str.translate table that deletes every character it has no entry for
+    """
+
+    def __missing__(self, key: int) -> None:
+        return None
+
+
+# Allow only letters, numbers, spaces, newlines, and some punctuation. Letters
+# are lowercased and dashes / underscores become spaces, all in a single pass.
+_TRANS = _CleanTable(
+    str.maketrans(
+        {
+            **{c: c for c in string.ascii_lowercase + string.digits + " '&"},
+            **{c.upper(): c for c in string.ascii_lowercase},
+            "-": " ",
+            "_": " ",
+            "\n": "\n",
+        }
+    )
+)
 
 
 def parse_args():
@@ -68,7 +106,7 @@ def parse_args():
         "--max-concurrent-dl",
         type=int,
         default=50,
-        help="Max number of pool procs at once. Default=50",
+        help="Max number of concurrent downloads. Default=50",
     )
 
     args = parser.parse_args()
@@ -82,64 +120,114 @@ def parse_args():
 
 
 def remove_accents(input_str: str) -> str:
+    # Decomposed accents, like anything else outside ASCII, are dropped by the
+    # ascii codec
     nfkd_form = unicodedata.normalize("NFKD", input_str)
-    return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
+    return nfkd_form.encode("ascii", "ignore").decode("ascii")
 
 
-def make_phrases(line: str, args: argparse.Namespace) -> list[str]:
+def wrap(line: str, width: int) -> list[str]:
     """
-    Cleans raw lyrics into usable passphrases
+    Splits a line on spaces into chunks of at most width, never breaking words
     """
-    clean_lines: list[str] = []
-    final_lines: list[str] = []
+    chunks: list[str] = []
+    current = ""
+
+    for word in line.split(" "):
+        if not current:
+            current = word
+        elif len(current) + 1 + len(word) <= width:
+            current += " " + word
+        else:
+            chunks.append(current)
+            current = word
+
+    if current:
+        chunks.append(current)
+
+    return chunks
 
-    # Allow only letters, numbers, spaces, and some punctuation
-    allowed_chars = re.compile("[^a-zA-Z0-9 '&]")
 
-    # Lowercase everything, deal with common punctuation, and try our best to replace
-    # any diacritics
-    line = allowed_chars.sub("", remove_accents(re.sub(r"[-_]", " ", line.lower())))
+def make_phrases(text: str, args: argparse.Namespace) -> Iterator[str]:
+    """
+    Cleans a block of raw lyrics, one lyric per line, into usable passphrases
+    """
+    # Try our best to replace any diacritics, then lowercase everything and deal
+    # with common punctuation. This is done once for the whole block.
+    text = remove_accents(text).translate(_TRANS)
 
     # Shrinks down multiple spaces
-    line = re.sub(r"\s\s+", " ", line)
-
-    # If line has an apostrophe make a duplicate without
-    #if "'" in line:
-    #    clean_lines.append(re.sub("'", "", line))
-
-    ## Making duplicating phrases including and / &
-    #if " and " in line:
-    #    clean_lines.append(re.sub(" and ", " & ", line))
-
-    #if "&" in line:
-    #    newline = re.sub("&", " and ", line)
-    #    newline = re.sub(r"\s+", " ", newline).strip()
-    #    clean_lines.append(newline)
-
-    # Add what is left to the list
-    clean_lines.append(line)
-
-    # Only keep items in the acceptable length
-    for item in clean_lines:
-        line_length = len(item)
-
-        if line_length < args.min:
-            continue
-        if line_length > args.max:
-            for l in textwrap.wrap(item, args.max, break_long_words=False):
-                print(f"Adding: {l}")
-                final_lines.append(l)
-        else:
-            final_lines.append(item)
+    text = _MULTISPACE.sub(" ", text)
+
+    for line in text.splitlines():
+        clean_lines = [line.strip()]
+
+        # If line has an apostrophe make a duplicate without
+        #if "'" in line:
+        #    clean_lines.append(re.sub("'", "", line))
+
+        ## Making duplicating phrases including and / &
+        #if " and " in line:
+        #    clean_lines.append(re.sub(" and ", " & ", line))
 
-    return final_lines
+        #if "&" in line:
+        #    newline = re.sub("&", " and ", line)
+        #    newline = re.sub(r"\s+", " ", newline).strip()
+        #    clean_lines.append(newline)
+
+        # Only keep items in the acceptable length
+        for item in clean_lines:
+            line_length = len(item)
+
+            if line_length < args.min:
+                continue
+            if line_length > args.max:
+                yield from wrap(item, args.max)
+            else:
+                yield item
+
+
+def clean_block(block: str, args: argparse.Namespace) -> set[str]:
+    """
+    Returns the unique passphrases found in a block of raw lyrics
+    """
+    return set(make_phrases(block, args))
+
+
+def clean_blocks_parallel(
+    blocks: Iterator[str], args: argparse.Namespace
+) -> Iterator[set[str]]:
+    """
+    Cleans blocks of raw lyrics over a pool of processes, yielding their phrases
+    """
+    # Cleaning is CPU bound, so blocks are spread over one process per core.
+    # Only a couple of blocks per process are queued at a time to keep the
+    # raw lyrics streamed rather than read into memory all at once.
+    with ProcessPoolExecutor() as executor:
+        max_pending = 2 * (os.cpu_count() or 1)
+        pending: deque[Future[set[str]]] = deque()
+
+        for block in blocks:
+            pending.append(executor.submit(clean_block, block, args))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        for future in pending:
+            yield future.result()
+
+
+def read_blocks(infile: TextIO) -> Iterator[str]:
+    """
+    Reads a text file in blocks of whole lines of roughly READ_BLOCK characters
+    """
+    while lines := infile.readlines(READ_BLOCK):
+        yield "".join(lines)
 
 
 def parse_artists(args: argparse.Namespace) -> list[str]:
     """
     Return a list of song artists for parsing
     """
-    whitelist = re.compile("[^a-zA-Z0-9-+]")
     artists: list[str] = []
 
     if args.artist:
@@ -152,139 +240,130 @@ def parse_artists(args: argparse.Namespace) -> list[str]:
 
     for artist in raw_artists:
         artist = artist.replace(" ", "+")
-        artist = whitelist.sub("", artist)
+        artist = _WHITELIST.sub("", artist)
         if artist not in artists:
             artists.append(artist)
 
     return artists
 
 
-def build_urls(artist: str) -> list[str]:
+async def build_urls(
+    session: aiohttp.ClientSession, artist: str, sem: asyncio.Semaphore
+) -> list[str]:
     """
     Creates a list of song URLs for a specific artist
     """
-    not_found = "We couldn't find any artists matching your query"
+    not_found = b"We couldn't find any artists matching your query"
     query_url = f"{SITE}/artist.php?name={artist}"
-    song_ids = []
-    regex = re.compile(r'href="/lyric/(.*?)/')
 
-    req = urllib.request.Request(query_url, headers=HEADER)
-    with urllib.request.urlopen(req) as response:
-        html = response.read().decode()
-
-    # The songs are stored by a unique ID
-    song_ids = re.findall(regex, html)
+    # Wait for a free slot before starting the request, so time spent queued
+    # behind other lookups doesn't count towards its timeout
+    async with sem:
+        print("[+] Looking up artist {}".format(artist))
+        try:
+            async with session.get(query_url) as response:
+                html = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            reason = str(err) or "timed out"
+            print("[!] Could not look up {} ({}), skipping".format(artist, reason))
+            return []
 
     if not_found in html:
         print("[!] Artist {} not found, skipping".format(artist))
 
-        # Clear out the "suggested" songs it finds in this scenario
-        song_ids = []
-    elif not song_ids:
+        # Don't bother with the "suggested" songs it finds in this scenario
+        return []
+
+    # The songs are stored by a unique ID. The same song is often listed under
+    # several albums, so only keep the first of each (dicts keep that order).
+    song_ids = list(dict.fromkeys(m.group(1) for m in _HREF.finditer(html)))
+
+    if not song_ids:
         print("[!] No songs found for {}, skipping".format(artist))
     else:
         print("[+] Found {} songs for artists {}".format(len(song_ids), artist))
 
     # The "print" URL shows us the easiest to decode version of the song
-    url_list = [SITE + "db-print.php?id=" + id for id in song_ids]
+    url_list = [SITE + "db-print.php?id=" + id.decode() for id in song_ids]
 
     return url_list
 
 
-def write_data(outfile: str, data: list[str]) -> None:
+async def fetch(session: aiohttp.ClientSession, url: str, out: BinaryIO) -> None:
     """
-    Generic helper function to write text to a file
+    Downloads a single song page and writes its lyrics to the output file
+    """
+    print(f"[+] Fetching {url} lyrics...")
+    try:
+        async with session.get(url) as response:
+            html = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        # One bad or slow page shouldn't throw away every other song
+        reason = str(err) or "timed out"
+        print("\n[!] Could not fetch {} ({}), skipping".format(url, reason))
+        return
+
+    lyrics = _PRE.search(html)
+
+    # We should always have a match... but if not, skip this url
+    if not lyrics:
+        print("\n[!] Found no lyrics at {}".format(url))
+        return
+
+    lines = [line for line in lyrics.group(1).splitlines() if line]
+    out.write(b"\n".join(lines) + b"\n")
+
+
+async def lyric_worker(
+    session: aiohttp.ClientSession, urls: Iterator[str], out: BinaryIO
+) -> None:
+    """
+    Keeps fetching songs until the shared URL iterator is exhausted
     """
-    with open(outfile, "a") as open_file:
-        for line in data:
-            if line:
-                open_file.write(f"{line}\n")
-
-
-def lyric_writer(lyric_file: str, lyrics_queue: Queue, max_concurrent: int) -> None:
-    finished = 0
-    while True:
-        lyrics: list[str] = lyrics_queue.get()
-        if lyrics == QUEUE_SENTINEL:  # type: ignore
-            finished += 1
-
-            if finished == max_concurrent:
-                break
-
-        else:
-            write_data(lyric_file, lyrics)
-
-
-def get_song_lyrics(queues: tuple[Queue, Queue]) -> None:
-    input_queue: Queue = queues[0]
-    lyrics_queue: Queue = queues[1]
-
-    while True:
-        url: str = input_queue.get()
-
-        if url == QUEUE_SENTINEL:
-            input_queue.task_done()
-            lyrics_queue.put(QUEUE_SENTINEL)
-            break
-
-        try:
-            print(f"[+] Fetching {url} lyrics...")
-            regex = re.compile(r"<pre.*?>(.*?)</pre>", re.DOTALL)
-            newline = re.compile(r"\r\n|\n")
-
-            req = urllib.request.Request(url, headers=HEADER)
-            with urllib.request.urlopen(req) as response:
-                html = response.read().decode()
-
-            lyrics = re.findall(regex, html)
-
-            # We should always have a match... but if not, skip this url
-            if not lyrics:
-                print("\n[!] Found no lyrics at {}".format(url))
-                continue
-
-            lyrics_queue.put(re.split(newline, lyrics[0]))
-        finally:
-            input_queue.task_done()
-
-
-def producer(input_q: Queue, urls: list[str], n_consumers: int) -> None:
-    """."""
     for url in urls:
-        while input_q.full():
-            sleep(1)
-
-        print(f"[+] Putting {url} in queue from producer")
-        input_q.put(url)
+        await fetch(session, url, out)
 
-    for _ in range(n_consumers):
-        while input_q.full():
-            sleep(1)
 
-        input_q.put(QUEUE_SENTINEL)
-
-
-def scrape_lyrics(
-    url_list: list[str], lyric_file: str, max_concurrent_dl: int
-) -> set[str]:
+async def scrape_lyrics(
+    session: aiohttp.ClientSession,
+    url_list: list[str],
+    out: BinaryIO,
+    max_concurrent_dl: int,
+) -> None:
     """
     Scrapes raw lyric data from a list of URLs
     """
+    # A fixed number of workers pull from the same iterator, so there are never
+    # more than max_concurrent_dl downloads in flight or waiting for a slot
+    urls = iter(url_list)
+    n_workers = min(max_concurrent_dl, len(url_list))
+    await asyncio.gather(*(lyric_worker(session, urls, out) for _ in range(n_workers)))
 
-    manager = multiprocessing.Manager()
-    lyrics_queue = manager.Queue()
-    input_queue = manager.Queue(int(max_concurrent_dl * 1.5))
 
-    with multiprocessing.Pool() as pool:
-        p = partial(producer, input_queue, url_list, max_concurrent_dl)
-        w = partial(get_song_lyrics)
-        c = partial(lyric_writer, lyric_file, lyrics_queue, max_concurrent_dl)
-        pool.apply_async(p)
-        pool.apply_async(c)
-        pool.map(w, [(input_queue, lyrics_queue) for _ in range(max_concurrent_dl)])
-        input_queue.join()
-        pool.close()
-        pool.join()
+async def scrape_artists(
+    artists: list[str], lyric_file: str, max_concurrent_dl: int
+) -> None:
+    """
+    Looks up every artist and scrapes the lyrics of all their songs
+    """
+    # One connection pool is shared by every request, so the connections to
+    # the site are kept alive across artists and songs.
+    connector = aiohttp.TCPConnector(limit=max_concurrent_dl, keepalive_timeout=30)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+
+    with open(lyric_file, "ab", buffering=WRITE_BUFFER) as out:
+        async with aiohttp.ClientSession(
+            headers=HEADER, connector=connector, timeout=timeout, raise_for_status=True
+        ) as session:
+            # Look up the artists concurrently, then download all of their
+            # songs in a single scrape
+            sem = asyncio.Semaphore(max_concurrent_dl)
+            url_lists = await asyncio.gather(
+                *(build_urls(session, artist, sem) for artist in artists)
+            )
+            url_list = [url for urls in url_lists for url in urls]
+
+            await scrape_lyrics(session, url_list, out, max_concurrent_dl)
 
 
 def main():
@@ -300,29 +379,35 @@ def main():
     lyric_file = f"raw-lyrics-{artists_str}-{now}"
     PASS_FILE = f"wordlist-{artists_str}-{now}"
 
-    final_phrases = []
-
-    # First, we grab all the lyrics for a given artist.
+    # First, we grab all the lyrics for every artist.
     # The scrape_lyrics function will write the raw lyrics to an output
     # file as it goes, which may come in handy if the program exits early
     # due to an error.
-    for artist in artists:
-        print("[+] Looking up artist {}".format(artist))
-        url_list = build_urls(artist)
-        if not url_list:
-            continue
+    asyncio.run(scrape_artists(artists, lyric_file, args.max_concurrent_dl))
 
-        scrape_lyrics(url_list, lyric_file, args.max_concurrent_dl)
+    # Choruses and shared lines repeat a lot, so only keep unique phrases
+    final_phrases: set[str] = set()
 
-    with open(lyric_file) as infile:
-        raw_words = infile.readlines()
+    # The raw lyrics are written exactly as the site sent them, so skip anything
+    # that isn't valid UTF-8 rather than crashing after the whole scrape
+    with open(lyric_file, encoding="utf-8", errors="ignore") as infile:
+        blocks = read_blocks(infile)
+        first_block = next(blocks, "")
+        second_block = next(blocks, None)
+
+        if second_block is None:
+            # A single block isn't worth starting up a process pool for
+            final_phrases.update(clean_block(first_block, args))
+        else:
+            all_blocks = chain((first_block, second_block), blocks)
+            for phrases in clean_blocks_parallel(all_blocks, args):
+                final_phrases.update(phrases)
 
-    final_phrases = [
-        phrase for lyric in raw_words for phrase in make_phrases(lyric, args)
-    ]
+    final_phrases.discard("")
 
     ### Write out the somewhat cleaned passphrases to a file
-    write_data(PASS_FILE, final_phrases)
+    with open(PASS_FILE, "w") as outfile:
+        outfile.writelines(f"{phrase}\n" for phrase in sorted(final_phrases))
 
     print("[+] All done!\n")
     print(f"Raw lyrics: {lyric_file}")